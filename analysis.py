@@ -1,12 +1,109 @@
-import json
+import os
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
+try:
+    from pyproj import Geod
+except ImportError:
+    Geod = None
+# numba only compiles the haversine fallback, so skip importing it when pyproj is there
+njit = None
+if Geod is None:
+    try:
+        from numba import njit
+    except ImportError:
+        pass
 import pandas as pd
 import numpy as np
 import folium
 from folium.features import GeoJsonTooltip
-from folium import plugins
-import matplotlib.pyplot as plt
-import colorsys
 from branca.colormap import linear
+from map_utils import compact_geometry, build_color_lut, color_lut_index
+
+EARTH_RADIUS_KM = 6371
+# WGS84 ellipsoid for geodesic segment lengths (when pyproj is installed)
+WGS84_GEOD = Geod(ellps='WGS84') if Geod is not None else None
+
+# Upper bounds of the AADT traffic volume categories
+AADT_BREAKS = [1000, 5000, 10000]
+AADT_RANGE_LABELS = ['0-1000', '1001-5000', '5001-10000', '10001+']
+# Map line weight for each AADT category
+WEIGHT_LUT = np.array([2, 4, 6, 8])
+
+def _line_length_km_numpy(lonlat):
+    """Vectorized haversine length in km of a (K, 2) array of [lon, lat] points"""
+    lon = np.radians(lonlat[:, 0])
+    lat = np.radians(lonlat[:, 1])
+    dlon = np.diff(lon)
+    dlat = np.diff(lat)
+    a = np.sin(dlat/2)**2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon/2)**2
+    return (2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))).sum()
+
+def _haversine_km(lon1, lat1, lon2, lat2):
+    """Distance in km between two [lon, lat] points given in degrees"""
+    lon1, lat1, lon2, lat2 = np.radians(lon1), np.radians(lat1), np.radians(lon2), np.radians(lat2)
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+if njit is not None:
+    # Compiled kernels: no temporary arrays per LineString, and cache=True keeps the
+    # compiled code in __pycache__ so only the first run pays for compilation
+    _haversine_km = njit(cache=True, fastmath=True)(_haversine_km)
+    
+    @njit(cache=True, fastmath=True)
+    def _line_length_km(lonlat):
+        """Sum of haversine distances along a (K, 2) array of [lon, lat] points"""
+        total = 0.0
+        for k in range(lonlat.shape[0] - 1):
+            total += _haversine_km(lonlat[k, 0], lonlat[k, 1], lonlat[k + 1, 0], lonlat[k + 1, 1])
+        return total
+else:
+    _line_length_km = _line_length_km_numpy
+
+def lonlat_array(coords):
+    """Return a (K, 2) float array of [lon, lat] from points that may carry an elevation"""
+    # Slicing each point handles files that mix [lon, lat] and [lon, lat, elevation]
+    return np.array([c[:2] for c in coords], dtype=np.float64).reshape(-1, 2)
+
+def line_length_km(coords):
+    """Return the length in km of a (K, 2) array or list of [lon, lat(, elevation)] points
+    
+    Uses the WGS84 geodesic from pyproj when it is installed, otherwise the
+    spherical haversine distance. Malformed coordinates give a length of 0.
+    """
+    try:
+        arr = coords if isinstance(coords, np.ndarray) else lonlat_array(coords)
+    except (TypeError, ValueError) as e:
+        print(f"Error calculating length for segment: {e}")
+        return 0.0
+    if len(arr) < 2:
+        return 0.0
+    
+    if WGS84_GEOD is not None:
+        return WGS84_GEOD.line_length(arr[:, 0], arr[:, 1]) / 1000
+    return float(_line_length_km(np.ascontiguousarray(arr)))
+
+def _float_or_nan(value):
+    """Return value for a float64 column, mapping missing (None) to NaN"""
+    return np.nan if value is None else value
+
+def _integer_column(values):
+    """Return values as a nullable Int64 array if every present value is a whole number, else unchanged"""
+    try:
+        arr = np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return values
+    present = arr[~np.isnan(arr)]
+    if np.all(np.mod(present, 1) == 0):
+        return pd.array(arr, dtype='Int64')
+    return values
 
 def analyze_dc_traffic_data(geojson_file):
     """
@@ -22,19 +119,19 @@ def analyze_dc_traffic_data(geojson_file):
     logger = logging.getLogger(__name__)
     # Load the GeoJSON data
     print(f"Loading data from {geojson_file}...")
+    # Read the file once and parse the bytes from memory (orjson skips the utf-8 decode)
+    raw = Path(geojson_file).read_bytes()
     try:
-        with open(geojson_file, 'r') as f:
-            data = json.load(f)
+        data = _json.loads(raw)
         print("Data loaded successfully")
-    except json.JSONDecodeError:
+    except ValueError:
+        # orjson/ujson/json decode errors all subclass ValueError
         print("Error: The file is not valid JSON. Attempting to fix truncated JSON...")
         try:
-            with open(geojson_file, 'r') as f:
-                content = f.read()
             # Try to fix by adding closing brackets if truncated
-            if not content.strip().endswith('}'):
-                content = content + ']}}'
-            data = json.loads(content)
+            if not raw.rstrip().endswith(b'}'):
+                raw = raw + b']}}'
+            data = _json.loads(raw)
             print("JSON fixed and loaded successfully")
         except:
             print("Unable to fix JSON file. Please check if the file is complete.")
@@ -42,6 +139,7 @@ def analyze_dc_traffic_data(geojson_file):
     
     # Extract features and create a DataFrame for analysis
     features = data.get('features', [])
+    
     if not features:
         print("No features found in the GeoJSON file")
         return None
@@ -60,68 +158,102 @@ def analyze_dc_traffic_data(geojson_file):
             if isinstance(first_coords[0], list) and len(first_coords[0]) > 0:
                 print(f"  Type: {type(first_coords[0][0])}")
     
-    # Create a list to store segment data
-    segments = []
+    # Preallocate one typed column per field instead of building a dict per segment
+    n = len(features)
+    route_id_col = np.empty(n, dtype=object)
+    aadt_col = np.empty(n, dtype=np.float64)
+    aadt_year_col = np.empty(n, dtype=np.float64)
+    from_measure_col = np.empty(n, dtype=np.float64)
+    to_measure_col = np.empty(n, dtype=np.float64)
+    gis_id_col = np.empty(n, dtype=object)
+    object_id_col = np.empty(n, dtype=object)
     
-    for feature in features:
+    # Segment lengths depend only on geometry, so reuse them while the GeoJSON file is unchanged
+    # (keyed by method, since geodesic and haversine lengths differ slightly)
+    length_method = 'geodesic' if WGS84_GEOD is not None else 'haversine'
+    length_cache = Path(geojson_file).with_suffix(f'.{length_method}.lengths.npy')
+    length_km_col = None
+    if length_cache.exists() and Path(geojson_file).stat().st_mtime <= length_cache.stat().st_mtime:
+        try:
+            cached_lengths = np.load(length_cache)
+        except Exception as e:
+            # An unreadable cache is just a miss; the lengths are recomputed below
+            print(f"Ignoring unreadable segment length cache: {e}")
+            cached_lengths = None
+        if cached_lengths is not None and len(cached_lengths) == n:
+            length_km_col = cached_lengths
+            print(f"Using cached segment lengths from {length_cache}")
+    compute_lengths = length_km_col is None
+    if compute_lengths:
+        length_km_col = np.zeros(n, dtype=np.float64)
+    
+    # Flat [lon, lat, lon, lat, ...] buffer of all LineString points, used for map centering
+    flat_lonlat = array('d')
+    # Features grouped by route for layer organization
+    routes = {}
+    
+    # Single pass over the features: table columns, centering coordinates and route groups
+    for i, feature in enumerate(features):
         props = feature.get('properties', {})
         geom = feature.get('geometry', {})
-        
-        # Extract the first and last coordinates for line direction
         coords = geom.get('coordinates', [])
-        start_coord = coords[0] if coords else None
-        end_coord = coords[-1] if coords else None
         
-        # Calculate segment length (approximate)
-        length_km = 0
-        if coords and len(coords) > 1:
-            from math import radians, sin, cos, sqrt, atan2
-            def haversine(coord1, coord2):
-                # Extract longitude and latitude, handling different coordinate formats
-                # Some GeoJSON files have [lon, lat] format, others have [lon, lat, elevation]
-                if isinstance(coord1, list) and len(coord1) >= 2:
-                    lon1, lat1 = coord1[0], coord1[1]
-                else:
-                    lon1, lat1 = coord1, 0  # Fallback, should not happen
-                    
-                if isinstance(coord2, list) and len(coord2) >= 2:
-                    lon2, lat2 = coord2[0], coord2[1]
-                else:
-                    lon2, lat2 = coord2, 0  # Fallback, should not happen
-                
-                # Calculate the distance between two points in km
-                R = 6371  # Earth radius in km
-                dlon = radians(lon2 - lon1)
-                dlat = radians(lat2 - lat1)
-                a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-                c = 2 * atan2(sqrt(a), sqrt(1-a))
-                return R * c
-            
+        # Calculate segment length (approximate) unless it came from the cache
+        if geom.get('type') == 'MultiLineString':
+            if compute_lengths:
+                length_km_col[i] = sum(line_length_km(part) for part in coords)
+        elif geom.get('type') == 'LineString' and coords:
             try:
-                for i in range(len(coords)-1):
-                    length_km += haversine(coords[i], coords[i+1])
-            except Exception as e:
-                # If there's an error in calculation, just set length to 0
+                line = lonlat_array(coords)
+            except (TypeError, ValueError) as e:
+                # Malformed geometry: keep the segment with a length of 0
                 print(f"Error calculating length for segment: {e}")
-                length_km = 0
+            else:
+                flat_lonlat.frombytes(line.tobytes())
+                if compute_lengths:
+                    length_km_col[i] = line_length_km(line)
+        
+        route_id = props.get('ROUTEID')
+        if route_id:
+            # Tag the feature with its row so the map can look up its style without
+            # relying on OBJECTID being present and unique
+            props['_style'] = i
+            routes.setdefault(route_id, []).append(feature)
         
-        segment = {
-            'route_id': props.get('ROUTEID'),
-            'aadt': props.get('AADT'),
-            'aadt_year': props.get('AADT_YEAR'),
-            'from_measure': props.get('FROMMEASURE'),
-            'to_measure': props.get('TOMEASURE'),
-            'length_km': length_km,
-            'gis_id': props.get('GIS_ID'),
-            'object_id': props.get('OBJECTID'),
-            'start_coord': start_coord,
-            'end_coord': end_coord,
-            'geometry': geom
-        }
-        segments.append(segment)
-    
-    # Create DataFrame
-    df = pd.DataFrame(segments)
+        # Missing numeric values become NaN so pandas skips them in the stats
+        route_id_col[i] = route_id
+        aadt_col[i] = _float_or_nan(props.get('AADT'))
+        aadt_year_col[i] = _float_or_nan(props.get('AADT_YEAR'))
+        from_measure_col[i] = _float_or_nan(props.get('FROMMEASURE'))
+        to_measure_col[i] = _float_or_nan(props.get('TOMEASURE'))
+        gis_id_col[i] = props.get('GIS_ID')
+        object_id_col[i] = props.get('OBJECTID')
+    
+    if compute_lengths:
+        # Write to a temp file and swap it into place, so an interrupted run
+        # never leaves a truncated cache behind (plain open keeps the usual umask permissions)
+        tmp_path = length_cache.with_name(f"{length_cache.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, length_km_col)
+            os.replace(tmp_path, length_cache)
+        except OSError as e:
+            print(f"Could not cache segment lengths: {e}")
+            if tmp_path.exists():
+                tmp_path.unlink()
+    
+    # Create DataFrame straight from the columns; whole-number fields use the nullable
+    # Int64 dtype so they stay integers while missing values become <NA>
+    df = pd.DataFrame({
+        'route_id': route_id_col,
+        'aadt': _integer_column(aadt_col),
+        'aadt_year': _integer_column(aadt_year_col),
+        'from_measure': from_measure_col,
+        'to_measure': to_measure_col,
+        'length_km': length_km_col,
+        'gis_id': gis_id_col,
+        'object_id': _integer_column(object_id_col)
+    })
     
     # Basic statistics
     print("\n=== Traffic Volume Statistics ===")
@@ -130,53 +262,43 @@ def analyze_dc_traffic_data(geojson_file):
     print(f"Min AADT: {df['aadt'].min()}")
     print(f"Max AADT: {df['aadt'].max()}")
     
-    # Calculate traffic volume categories
-    traffic_ranges = {
-        '0-1000': len(df[df['aadt'] <= 1000]),
-        '1001-5000': len(df[(df['aadt'] > 1000) & (df['aadt'] <= 5000)]),
-        '5001-10000': len(df[(df['aadt'] > 5000) & (df['aadt'] <= 10000)]),
-        '10001+': len(df[df['aadt'] > 10000])
-    }
+    # Calculate traffic volume categories in one vectorized pass
+    # (right=True keeps the upper edge of each range inclusive, e.g. 1000 -> '0-1000')
+    aadt_arr = df['aadt'].to_numpy(dtype=np.float64, na_value=np.nan)
+    aadt_bin = np.digitize(aadt_arr, AADT_BREAKS, right=True)
+    counts = np.bincount(aadt_bin[~np.isnan(aadt_arr)], minlength=len(AADT_RANGE_LABELS))
+    traffic_ranges = dict(zip(AADT_RANGE_LABELS, counts.tolist()))
     print("\nTraffic Volume Distribution:")
     for range_name, count in traffic_ranges.items():
         print(f"{range_name}: {count} segments ({count/len(df)*100:.1f}%)")
     
     # Route statistics
     print("\n=== Route Statistics ===")
-    route_stats = df.groupby('route_id').agg({
-        'aadt': ['mean', 'min', 'max', 'count'],
-        'length_km': 'sum'
-    })
-    route_stats.columns = ['avg_aadt', 'min_aadt', 'max_aadt', 'segment_count', 'total_length_km']
+    # Only the needed columns go into the groupby; named aggregation sets the column names,
+    # and the group sort is skipped since the table is sorted by avg_aadt below
+    route_stats = df[['route_id', 'aadt', 'length_km']].groupby('route_id', sort=False, observed=True).agg(
+        avg_aadt=('aadt', 'mean'),
+        min_aadt=('aadt', 'min'),
+        max_aadt=('aadt', 'max'),
+        segment_count=('aadt', 'count'),
+        total_length_km=('length_km', 'sum')
+    ).astype({'avg_aadt': 'float64'})
     print(route_stats.sort_values('avg_aadt', ascending=False))
     
     # Create folium map
     print("\nCreating Folium map visualization...")
     
-    # Determine center of map (average of all coordinates)
-    all_lats = []
-    all_lons = []
-    
-    for feature in features:
-        geometry = feature.get('geometry', {})
-        coords = geometry.get('coordinates', [])
-        
-        # Handle different geometry types and coordinate formats
-        if geometry.get('type') == 'LineString':
-            for coord in coords:
-                if isinstance(coord, list) and len(coord) >= 2:
-                    all_lons.append(coord[0])
-                    all_lats.append(coord[1])
-    
-    if not all_lats or not all_lons:
+    # Determine center of map (average of all LineString coordinates)
+    if not flat_lonlat:
         # Default to DC center if no coordinates
         center = [38.9072, -77.0369]
     else:
-        # Calculate average lat/lon for centering
-        center = [np.mean(all_lats), np.mean(all_lons)]
+        # Calculate average lat/lon for centering over the flat [lon, lat] buffer
+        flat = np.frombuffer(flat_lonlat, dtype=np.float64).reshape(-1, 2)
+        center = [float(flat[:, 1].mean()), float(flat[:, 0].mean())]
     
     # Create base map
-    m = folium.Map(location=center, zoom_start=13, tiles='cartodbpositron')
+    m = folium.Map(location=center, zoom_start=13, tiles='cartodbpositron', prefer_canvas=True)
     
     # Create colormap for traffic volumes
     min_traffic = df['aadt'].min()
@@ -185,67 +307,47 @@ def analyze_dc_traffic_data(geojson_file):
     colormap.caption = 'Average Annual Daily Traffic (AADT)'
     m.add_child(colormap)
     
-    # Group features by route for layer organization
-    routes = {}
-    for feature in features:
-        props = feature.get('properties', {})
-        route_id = props.get('ROUTEID')
-        
-        if not route_id:
-            continue
-            
-        if route_id not in routes:
-            routes[route_id] = []
-            
-        routes[route_id].append(feature)
+    # Precompute every segment's style so rendering is one dict lookup per feature:
+    # color from a sampled colormap table, width from the AADT category
+    color_lut = build_color_lut(colormap, min_traffic, max_traffic)
+    color_idx = color_lut_index(aadt_arr, min_traffic, max_traffic, len(color_lut))
+    segment_styles = [
+        {'color': color_lut[i], 'weight': weight, 'opacity': 0.8}
+        for i, weight in zip(color_idx.tolist(), WEIGHT_LUT[aadt_bin].tolist())
+    ]
     
     # Create a feature group for each route
-    for route_id, route_features in routes.items():
+    def build_route_layer(route_item):
+        route_id, route_features = route_item
         fg = folium.FeatureGroup(name=f"Route {route_id}")
         
+        # Collect the route's segments with traffic data into a single FeatureCollection,
+        # reusing the original features rather than copying them into new dicts
+        route_segments = []
         for feature in route_features:
-            props = feature.get('properties', {})
-            
-            # Choose color based on AADT
-            aadt = props.get('AADT')
-            if not aadt:
+            props = feature['properties']
+            if not props.get('AADT'):
                 continue
-                
-            # Determine line width based on AADT (thicker for higher traffic)
-            if aadt <= 1000:
-                weight = 2
-            elif aadt <= 5000:
-                weight = 4
-            elif aadt <= 10000:
-                weight = 6
-            else:
-                weight = 8
+            # The tooltip needs every field on each feature, even when it's empty
+            props.setdefault('AADT_YEAR', None)
+            props.setdefault('OBJECTID', None)
             
-            # Create a GeoJSON feature for the segment
-            geojson_segment = {
-                'type': 'Feature',
-                'geometry': feature.get('geometry'),
-                'properties': {
-                    'AADT': aadt,
-                    'RouteID': route_id,
-                    'Year': props.get('AADT_YEAR'),
-                    'ObjectID': props.get('OBJECTID'),
-                    'FromMeasure': props.get('FROMMEASURE'),
-                    'ToMeasure': props.get('TOMEASURE')
-                }
-            }
-            
-            # Add segment to feature group
+            # Round and simplify the geometry to keep the embedded GeoJSON small
+            try:
+                compact_geometry(feature.get('geometry') or {})
+            except Exception as e:
+                print(f"Error adding segment to map: {e}")
+                continue
+            route_segments.append(feature)
+        
+        # Add the whole route as one GeoJson layer, styled per segment
+        if route_segments:
             try:
                 gj = folium.GeoJson(
-                    geojson_segment,
-                    style_function=lambda x, aadt=aadt, weight=weight: {
-                        'color': colormap(aadt),
-                        'weight': weight,
-                        'opacity': 0.8
-                    },
+                    {'type': 'FeatureCollection', 'features': route_segments},
+                    style_function=lambda x: segment_styles[x['properties']['_style']],
                     tooltip=folium.GeoJsonTooltip(
-                        fields=['RouteID', 'AADT', 'Year', 'ObjectID'],
+                        fields=['ROUTEID', 'AADT', 'AADT_YEAR', 'OBJECTID'],
                         aliases=['Route ID:', 'Traffic Volume:', 'Year:', 'Segment ID:'],
                         localize=True,
                         sticky=False,
@@ -262,14 +364,23 @@ def analyze_dc_traffic_data(geojson_file):
                 )
                 gj.add_to(fg)
             except Exception as e:
-                print(f"Error adding segment to map: {e}")
-                continue
-                
+                print(f"Error adding route {route_id} to map: {e}")
+        
+        return fg
+    
+    # Routes are independent, so build their layers in a thread pool, then attach
+    # them to the map on this thread in the original order (add_to isn't thread-safe)
+    with ThreadPoolExecutor() as executor:
+        route_layers = list(executor.map(build_route_layer, routes.items()))
+    for fg in route_layers:
         fg.add_to(m)
     
     # Add layer control
     folium.LayerControl().add_to(m)
     
+    # Map plugins are only needed here, so import them late to keep startup fast
+    from folium import plugins
+    
     # Add fullscreen button
     plugins.Fullscreen().add_to(m)
     
@@ -281,7 +392,8 @@ def analyze_dc_traffic_data(geojson_file):
     
     # Save map to HTML file
     output_file = 'dc_traffic_map.html'
-    m.save(output_file)
+    # Render once and write the bytes directly
+    Path(output_file).write_bytes(m.get_root().render().encode('utf-8'))
     print(f"Map saved to {output_file}")
     
     return df, m
@@ -5,12 +5,25 @@ This script generates an interactive map of Washington DC traffic volumes.
 It handles GeoJSON files with LineString geometries and AADT (Annual Average Daily Traffic) data.
 """
 
-import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
 import pandas as pd
 import numpy as np
 import folium
 from folium.features import GeoJsonTooltip
 import branca.colormap as cm
+from map_utils import compact_geometry, build_color_lut, color_lut_index
+
+# Line width by traffic volume: <=2000, <=5000, <=10000 and above vehicles/day
+WIDTH_BREAKS = [2000, 5000, 10000]
+WIDTH_LUT = np.array([2, 3, 5, 7])
 
 def generate_traffic_map(filename):
     """Generate a Folium map from a GeoJSON file with traffic data"""
@@ -18,20 +31,18 @@ def generate_traffic_map(filename):
     
     # Load the GeoJSON data
     try:
-        with open(filename, 'r') as f:
-            data = json.load(f)
-            print("File loaded successfully")
-    except json.JSONDecodeError as e:
+        # Read the file once and parse the bytes from memory (orjson skips the utf-8 decode)
+        raw = Path(filename).read_bytes()
+        data = _json.loads(raw)
+        print("File loaded successfully")
+    except ValueError as e:
+        # orjson/ujson/json decode errors all subclass ValueError
         print(f"Error parsing JSON: {e}")
         print("Attempting to fix truncated file...")
         
         try:
-            with open(filename, 'r') as f:
-                content = f.read()
-            
-            # Try to fix truncated file
-            fixed_content = content + "]}"
-            data = json.loads(fixed_content)
+            # Try to fix truncated file without reading it again
+            data = _json.loads(raw + b"]}")
             print("Fixed JSON successfully")
         except Exception as e:
             print(f"Could not fix JSON: {e}")
@@ -40,35 +51,44 @@ def generate_traffic_map(filename):
         print(f"Error loading file: {e}")
         return None
     
-    # Check if we have features
     features = data.get('features', [])
+    
+    # Check if we have features
     if not features:
         print("No features found in the GeoJSON file")
         return None
     
     print(f"Found {len(features)} features")
     
-    # Create a map centered around DC
-    dc_center = [38.9072, -77.0369]  # Washington DC
-    m = folium.Map(location=dc_center, zoom_start=12, tiles='CartoDB positron')
-    
     # Sample some coordinates to get better centering
     sample_coords = []
     
-    # Extract AADT values to create appropriate color scale
-    aadt_values = []
-    unique_routes = set()
+    # Extract AADT values into one typed array (missing values become 0)
+    aadt_arr = np.fromiter(
+        (f.get('properties', {}).get('AADT') or 0 for f in features),
+        dtype=np.int64,
+        count=len(features)
+    )
+    aadt_values = aadt_arr[aadt_arr != 0]
+    if aadt_values.size:
+        min_aadt, max_aadt = int(aadt_values.min()), int(aadt_values.max())
+    else:
+        min_aadt, max_aadt = 0, 0
+    
+    route_groups = {}
     
-    for feature in features:
+    # Single pass: group by route and sample coordinates
+    for i, feature in enumerate(features):
         props = feature.get('properties', {})
-        aadt = props.get('AADT')
         route_id = props.get('ROUTEID')
         
-        if aadt:
-            aadt_values.append(aadt)
-        
         if route_id:
-            unique_routes.add(route_id)
+            # Tag the feature with its index so the map can look up its style without
+            # relying on OBJECTID being present and unique
+            props['_style'] = i
+            if route_id not in route_groups:
+                route_groups[route_id] = []
+            route_groups[route_id].append(feature)
             
         # Sample coordinates from geometry
         geom = feature.get('geometry', {})
@@ -79,19 +99,20 @@ def generate_traffic_map(filename):
                 if len(coords) > 0 and isinstance(coords[0], list) and len(coords[0]) >= 2:
                     sample_coords.append([coords[0][1], coords[0][0]])  # [lat, lon]
     
-    print(f"Found {len(unique_routes)} unique routes")
-    print(f"AADT range: {min(aadt_values) if aadt_values else 0} - {max(aadt_values) if aadt_values else 0}")
+    print(f"Found {len(route_groups)} unique routes")
+    print(f"AADT range: {min_aadt} - {max_aadt}")
+    
+    # Center the map on the sampled coordinates, falling back to DC
+    if sample_coords:
+        center = np.mean(sample_coords, axis=0).tolist()
+    else:
+        center = [38.9072, -77.0369]  # Washington DC
     
-    # Recenter map if we have enough coordinates
-    if len(sample_coords) > 10:
-        avg_lat = np.mean([coord[0] for coord in sample_coords])
-        avg_lon = np.mean([coord[1] for coord in sample_coords])
-        m = folium.Map(location=[avg_lat, avg_lon], zoom_start=12, tiles='CartoDB positron')
+    # Create the map once the center is known
+    m = folium.Map(location=center, zoom_start=12, tiles='CartoDB positron', prefer_canvas=True)
     
     # Create a colormap for AADT values
-    if aadt_values:
-        min_aadt = min(aadt_values)
-        max_aadt = max(aadt_values)
+    if aadt_values.size:
         colormap = cm.LinearColormap(
             ['green', 'yellow', 'orange', 'red'],
             vmin=min_aadt,
@@ -100,19 +121,21 @@ def generate_traffic_map(filename):
         colormap.caption = 'Annual Average Daily Traffic'
         m.add_child(colormap)
     
-    # Group features by route
-    route_groups = {}
-    for feature in features:
-        props = feature.get('properties', {})
-        route_id = props.get('ROUTEID')
-        
-        if route_id:
-            if route_id not in route_groups:
-                route_groups[route_id] = []
-            route_groups[route_id].append(feature)
+    # Style per segment based on traffic volume, computed once up front
+    widths = WIDTH_LUT[np.digitize(aadt_arr, WIDTH_BREAKS, right=True)]
+    segment_styles = []
+    if aadt_values.size:
+        # Colors come from a table sampled once from the colormap, indexed in one vectorized pass
+        color_lut = build_color_lut(colormap, min_aadt, max_aadt)
+        color_idx = color_lut_index(aadt_arr, min_aadt, max_aadt, len(color_lut))
+        segment_styles = [
+            {'color': color_lut[i], 'weight': width, 'opacity': 0.8}
+            for i, width in zip(color_idx.tolist(), widths.tolist())
+        ]
     
     # Create a feature group for each route
-    for route_id, route_features in route_groups.items():
+    def build_route_layer(route_item):
+        route_id, route_features = route_item
         fg = folium.FeatureGroup(name=f"Route {route_id}")
         
         for feature in route_features:
@@ -121,15 +144,6 @@ def generate_traffic_map(filename):
             
             if not aadt:
                 continue
-                
-            # Determine line width based on traffic volume
-            width = 2
-            if aadt > 10000:
-                width = 7
-            elif aadt > 5000:
-                width = 5
-            elif aadt > 2000:
-                width = 3
             
             # Create tooltip content
             tooltip_content = f"""
@@ -142,19 +156,24 @@ def generate_traffic_map(filename):
             
             # Add the feature to the map
             try:
+                # Round and simplify the geometry to keep the embedded GeoJSON small
+                compact_geometry(feature.get('geometry') or {})
                 gj = folium.GeoJson(
                     feature,
-                    style_function=lambda x, aadt=aadt, width=width: {
-                        'color': colormap(aadt) if aadt_values else 'blue',
-                        'weight': width,
-                        'opacity': 0.8
-                    }
+                    style_function=lambda x: segment_styles[x['properties']['_style']]
                 )
                 folium.Tooltip(tooltip_content).add_to(gj)
                 gj.add_to(fg)
             except Exception as e:
                 print(f"Error adding segment to map: {e}")
         
+        return fg
+    
+    # Routes are independent, so build their layers in a thread pool, then attach
+    # them to the map on this thread in the original order (add_to isn't thread-safe)
+    with ThreadPoolExecutor() as executor:
+        route_layers = list(executor.map(build_route_layer, route_groups.items()))
+    for fg in route_layers:
         fg.add_to(m)
     
     # Add layer control to toggle routes
@@ -162,7 +181,8 @@ def generate_traffic_map(filename):
     
     # Save the map to an HTML file
     output_file = 'dc_traffic_map.html'
-    m.save(output_file)
+    # Render once and write the bytes directly
+    Path(output_file).write_bytes(m.get_root().render().encode('utf-8'))
     print(f"Map saved to {output_file}")
     
     return m
@@ -0,0 +1,54 @@
+"""
+Map helpers shared by analysis.py and html_generator.py.
+
+Shrinks LineString/MultiLineString geometry before it is embedded in the
+generated HTML map, and samples the AADT colormap into a lookup table.
+"""
+
+try:
+    import shapely
+except ImportError:
+    shapely = None
+import numpy as np
+
+# Embedded geometry: 5 decimal places is about 1 m, and lines with more than
+# SIMPLIFY_MIN_POINTS points are simplified within SIMPLIFY_TOLERANCE degrees
+COORD_PRECISION = 5
+SIMPLIFY_MIN_POINTS = 20
+SIMPLIFY_TOLERANCE = 1e-5
+
+# Number of colors sampled from the AADT colormap
+COLOR_LUT_SIZE = 1024
+
+def compact_line(coords):
+    """Return [lon, lat] points rounded to COORD_PRECISION, simplifying long lines when shapely is available"""
+    # Elevation is dropped since the map only draws lon/lat; slicing each point
+    # copes with lines that mix 2D and 3D points, and malformed input is left as is
+    try:
+        arr = np.array([c[:2] for c in coords], dtype=np.float64).reshape(-1, 2)
+    except (TypeError, ValueError):
+        return coords
+    if len(arr) == 0:
+        return coords
+
+    if shapely is not None and len(arr) > SIMPLIFY_MIN_POINTS:
+        # Ramer-Douglas-Peucker; endpoints are always kept
+        arr = shapely.get_coordinates(shapely.simplify(shapely.linestrings(arr), SIMPLIFY_TOLERANCE))
+    return np.round(arr, COORD_PRECISION).tolist()
+
+def compact_geometry(geom):
+    """Shrink a LineString/MultiLineString geometry in place before it is embedded in the map"""
+    if geom.get('type') == 'LineString':
+        geom['coordinates'] = compact_line(geom.get('coordinates', []))
+    elif geom.get('type') == 'MultiLineString':
+        geom['coordinates'] = [compact_line(part) for part in geom.get('coordinates', [])]
+
+def build_color_lut(colormap, vmin, vmax, size=COLOR_LUT_SIZE):
+    """Sample a branca colormap into a table of size hex colors evenly spanning [vmin, vmax]"""
+    return [colormap(vmin + i * (vmax - vmin) / (size - 1)) for i in range(size)]
+
+def color_lut_index(values, vmin, vmax, size):
+    """Return the color table index of each value (NaN maps to the first entry)"""
+    span = (vmax - vmin) or 1
+    scaled = (np.clip(np.nan_to_num(values, nan=vmin), vmin, vmax) - vmin) / span
+    return np.rint(scaled * (size - 1)).astype(np.int64)